@@ -1,30 +1,45 @@
 """Benchmark offline inference throughput."""
-import string
 import argparse
-import json
-import random
 import time
-from typing import List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
 
+import numpy as np
 import torch
+import transformers
+from packaging.version import Version
 from transformers import (AutoConfig, AutoTokenizer, AutoModelForCausalLM,
                           PreTrainedTokenizerBase)
 from tqdm import tqdm
 
 from vllm import LLM, SamplingParams
 
+_TRANSFORMERS_VERSION = Version(transformers.__version__)
+
+@dataclass(frozen=True)
+class Request:
+    """A sampled benchmark request."""
+    # NOTE: Declared manually because dataclass(slots=True) needs Python 3.10.
+    __slots__ = ("prompt", "prompt_token_ids", "prompt_len", "output_len")
+
+    prompt: str
+    prompt_token_ids: List[int]
+    prompt_len: int
+    output_len: int
+
 def seed_everything(seed: int):
     import random, os
-    import numpy as np
     import torch
     
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    
-seed_everything(42)
+    # NOTE: Checking for CUDA does not initialize the CUDA context, and
+    # manual_seed_all seeds every visible device lazily.
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
 
 def get_tokenizer(model_name: str) -> PreTrainedTokenizerBase:
     config = AutoConfig.from_pretrained(model_name)
@@ -37,112 +52,80 @@ def get_tokenizer(model_name: str) -> PreTrainedTokenizerBase:
         return tokenizer
     return AutoTokenizer.from_pretrained(model_name)
 
-# def sample_requests(
-#     dataset_path: str,
-#     num_requests: int,
-#     tokenizer: PreTrainedTokenizerBase,
-# ) -> List[Tuple[str, int, int]]:
-#     # Load the dataset.
-#     with open(dataset_path) as f:
-#         dataset = json.load(f)
-#     # Filter out the conversations with less than 2 turns.
-#     dataset = [
-#         data for data in dataset
-#         if len(data["conversations"]) >= 2
-#     ]
-#     # Only keep the first two turns of each conversation.
-#     dataset = [
-#         (data["conversations"][0]["value"], data["conversations"][1]["value"])
-#         for data in dataset
-#     ]
-
-#     # Tokenize the prompts and completions.
-#     prompts = [prompt for prompt, _ in dataset]
-#     prompt_token_ids = tokenizer(prompts).input_ids
-#     completions = [completion for _, completion in dataset]
-#     completion_token_ids = tokenizer(completions).input_ids
-#     tokenized_dataset = []
-#     for i in range(len(dataset)):
-#         output_len = len(completion_token_ids[i])
-#         tokenized_dataset.append((prompts[i], prompt_token_ids[i], output_len))
-
-#     # Filter out too long sequences.
-#     filtered_dataset: List[Tuple[str, int, int]] = []
-#     for prompt, prompt_token_ids, output_len in tokenized_dataset:
-#         prompt_len = len(prompt_token_ids)
-#         if prompt_len < 4 or output_len < 4:
-#             # Prune too short sequences.
-#             continue
-#         if prompt_len > 1024 or prompt_len + output_len > 2048:
-#             # Prune too long sequences.
-#             continue
-#         filtered_dataset.append((prompt, prompt_len, output_len))
-
-#     # Sample the requests.
-#     sampled_requests = random.sample(filtered_dataset, num_requests)
-#     return sampled_requests
-
 def sample_requests(
-    dataset_path: str,
     num_requests: int,
     tokenizer: PreTrainedTokenizerBase,
-) -> List[Tuple[str, int, int]]:
-    res = []
-    for _ in range(num_requests):
-        # prompt = ''.join(
-        #     random.choices(
-        #         string.ascii_uppercase + string.digits,
-        #         k=random.randint(args.min_prompt_len, args.max_prompt_len)))
-        prompt = '!' * random.randint(args.min_prompt_len, args.max_prompt_len)
-        prompt_len = len(tokenizer(prompt).input_ids)
-        output_len = random.randint(args.min_response_len, args.max_response_len)
-        res.append((prompt, prompt_len, output_len))
+) -> List[Request]:
+    # NOTE: The prompts are synthetic runs of '!' with lengths sampled from
+    # [min_prompt_len, max_prompt_len]. See benchmark_serving.py for sampling
+    # requests from ShareGPT.
+    # Sample all the lengths up-front.
+    prompt_lens = np.random.randint(args.min_prompt_len,
+                                    args.max_prompt_len + 1,
+                                    size=num_requests).tolist()
+    output_lens = np.random.randint(args.min_response_len,
+                                    args.max_response_len + 1,
+                                    size=num_requests).tolist()
+
+    # Slice the prompts out of a single max-length string.
+    max_prompt = '!' * args.max_prompt_len
+    prompts = [max_prompt[:num_chars] for num_chars in prompt_lens]
 
+    # Every prompt is a run of a single character, so the token IDs only
+    # depend on the number of characters. Tokenize each distinct length once,
+    # in a single batched call.
+    unique_lens = sorted(set(prompt_lens))
+    unique_token_ids = tokenizer([max_prompt[:l] for l in unique_lens]).input_ids
+    token_ids_table: Dict[int, List[int]] = dict(
+        zip(unique_lens, unique_token_ids))
+    # NOTE: Requests with the same prompt length share one token ID list, so
+    # the memory for the token IDs scales with the number of distinct lengths,
+    # not with the number of requests. They are kept as Python lists because
+    # the engine concatenates the prompt and output token IDs as lists.
+    prompt_token_ids = [token_ids_table[l] for l in prompt_lens]
+
+    res = [
+        Request(prompt, token_ids, len(token_ids), output_len)
+        for prompt, token_ids, output_len in zip(prompts, prompt_token_ids,
+                                                 output_lens)
+    ]
     return res
 
 def run_vllm(
-    requests: List[Tuple[str, int, int]],
-    model: str,
-    tensor_parallel_size: int,
-    seed: int,
+    requests: List[Request],
+    llm: LLM,
     n: int,
     use_beam_search: bool,
 ) -> float:
-    llm = LLM(
-        model=model,
-        tensor_parallel_size=tensor_parallel_size,
-        seed=seed,
-        use_dummy_weights=True,
-        max_num_seqs=args.batch_size,
-        max_num_batched_tokens=args.batch_size * (args.max_prompt_len + args.max_response_len + 1),
-    )
-
-    # Add the requests to the engine.
-    for prompt, _, output_len in requests:
-        sampling_params = SamplingParams(
-            n=n,
-            temperature=0.0 if use_beam_search else 1.0,
-            top_p=1.0,
-            use_beam_search=use_beam_search,
-            ignore_eos=True,
-            max_tokens=output_len,
-        )
-        # FIXME(woosuk): Do not use internal method.
-        llm._add_request(
-            prompt=prompt,
-            prompt_token_ids=None,
-            sampling_params=sampling_params,
-        )
+    # NOTE: The requests only differ in max_tokens, so share one
+    # SamplingParams object per distinct output length.
+    sampling_params_cache: Dict[int, SamplingParams] = {}
+    for request in requests:
+        output_len = request.output_len
+        if output_len not in sampling_params_cache:
+            sampling_params_cache[output_len] = SamplingParams(
+                n=n,
+                temperature=0.0 if use_beam_search else 1.0,
+                top_p=1.0,
+                use_beam_search=use_beam_search,
+                ignore_eos=True,
+                max_tokens=output_len,
+            )
+    prompt_token_ids = [request.prompt_token_ids for request in requests]
+    sampling_params = [
+        sampling_params_cache[request.output_len] for request in requests
+    ]
 
-    start = time.time()
-    # FIXME(woosuk): Do use internal method.
-    llm._run_engine(use_tqdm=True)
-    end = time.time()
+    start = time.perf_counter()
+    llm.generate(prompt_token_ids=prompt_token_ids,
+                 sampling_params=sampling_params,
+                 use_tqdm=True)
+    end = time.perf_counter()
     return end - start
 
 
 def run_hf(
-    requests: List[Tuple[str, int, int]],
+    requests: List[Request],
     model: str,
     tokenizer: PreTrainedTokenizerBase,
     n: int,
@@ -150,74 +133,201 @@ def run_hf(
     max_batch_size: int,
 ) -> float:
     assert not use_beam_search
-    tokenizer = get_tokenizer(model)
-    llm = AutoModelForCausalLM.from_pretrained(
-        model, torch_dtype=torch.float16)
+    llm = None
+    # NOTE: `attn_implementation` needs transformers >= 4.36, and
+    # FlashAttention-2 needs an Ampere or newer GPU. The GPU is only checked
+    # at the first forward pass, so check it here.
+    if (_TRANSFORMERS_VERSION >= Version("4.36.0")
+            and torch.cuda.get_device_capability()[0] >= 8):
+        try:
+            llm = AutoModelForCausalLM.from_pretrained(
+                model, torch_dtype=torch.float16,
+                attn_implementation="flash_attention_2")
+        except (ImportError, ValueError):
+            # FlashAttention-2 is not installed or not supported by the model.
+            pass
+    if llm is None:
+        # Let transformers pick the attention implementation: SDPA when the
+        # model supports it, and eager attention otherwise.
+        llm = AutoModelForCausalLM.from_pretrained(
+            model, torch_dtype=torch.float16)
     llm = llm.cuda()
 
-    pbar = tqdm(total=len(requests))
-    start = time.time()
+    # Decode with a pre-allocated static KV cache and compile the forward pass,
+    # so that each decoding step is replayed as a CUDA graph. This needs
+    # transformers >= 4.45 (for passing a StaticCache to generate) and a model
+    # that supports the static cache. FlashAttention-2 does not support it.
+    use_static_cache = (
+        _TRANSFORMERS_VERSION >= Version("4.45.0")
+        and (getattr(llm, "_supports_static_cache", False)
+             or getattr(llm, "_can_compile_fullgraph", False))
+        and llm.config._attn_implementation != "flash_attention_2")
+    # NOTE: To keep the number of compiled shapes small, all the batches share
+    # one cache of a fixed size, the batches are padded to max_batch_size, and
+    # the prompts are padded to a multiple of 64 tokens.
+    max_seq_len = 2048
+    pad_to_multiple_of = 64 if use_static_cache else None
+    if use_static_cache:
+        from transformers import StaticCache
+        static_cache = StaticCache(config=llm.config,
+                                   max_batch_size=max_batch_size * n,
+                                   max_cache_len=max_seq_len,
+                                   device=llm.device,
+                                   dtype=torch.float16)
+        llm.forward = torch.compile(llm.forward, mode="reduce-overhead",
+                                    fullgraph=True)
+
+    def get_padded_len(prompt_len: int) -> int:
+        if pad_to_multiple_of is None:
+            return prompt_len
+        return -(-prompt_len // pad_to_multiple_of) * pad_to_multiple_of
+
+    # Sort the requests by length so that each batch holds sequences of
+    # similar lengths, minimizing the padding tokens.
+    requests = sorted(requests, key=lambda x: (x.prompt_len, x.output_len))
+
+    # Group the requests into batches.
+    batches: List[Tuple[List[str], int, int]] = []
     batch: List[str] = []
     max_prompt_len = 0
     max_output_len = 0
     for i in range(len(requests)):
-        prompt, prompt_len, output_len = requests[i]
+        request = requests[i]
         # Add the prompt to the batch.
-        batch.append(prompt)
-        max_prompt_len = max(max_prompt_len, prompt_len)
-        max_output_len = max(max_output_len, output_len)
+        batch.append(request.prompt)
+        max_prompt_len = max(max_prompt_len,
+                             get_padded_len(request.prompt_len))
+        max_output_len = max(max_output_len, request.output_len)
         if len(batch) < max_batch_size and i != len(requests) - 1:
             # Check if we can add more requests to the batch.
-            _, next_prompt_len, next_output_len = requests[i + 1]
+            next_request = requests[i + 1]
+            next_prompt_len = get_padded_len(next_request.prompt_len)
             if (max(max_prompt_len, next_prompt_len) + max(
-                max_output_len, next_output_len)) <= 2048:
+                max_output_len, next_request.output_len)) <= max_seq_len:
                 # We can add more requests to the batch.
                 continue
+        batches.append((batch, max_prompt_len, max_output_len))
+
+        # Clear the batch.
+        batch = []
+        max_prompt_len = 0
+        max_output_len = 0
 
-        # Generate the sequences.
-        input_ids = tokenizer(batch, return_tensors="pt", padding=True).input_ids
-        llm_outputs = llm.generate(
-            input_ids=input_ids.cuda(),
+    def tokenize(batch: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        if use_static_cache:
+            # Pad the batch to a fixed size by repeating the last prompt.
+            batch = batch + [batch[-1]] * (max_batch_size - len(batch))
+        inputs = tokenizer(batch, return_tensors="pt", padding=True,
+                           pad_to_multiple_of=pad_to_multiple_of,
+                           return_attention_mask=True)
+        # The attention mask lets the attention kernels skip the padding tokens.
+        return inputs.input_ids.pin_memory(), inputs.attention_mask.pin_memory()
+
+    def generate(input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                 max_output_len: int) -> torch.Tensor:
+        kwargs = {}
+        if use_static_cache:
+            static_cache.reset()
+            kwargs["past_key_values"] = static_cache
+        return llm.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
             do_sample=not use_beam_search,
             num_return_sequences=n,
             temperature=1.0,
             top_p=1.0,
             use_cache=True,
             max_new_tokens=max_output_len,
+            **kwargs,
         )
-        # Include the decoding time.
-        tokenizer.batch_decode(llm_outputs, skip_special_tokens=True)
-        pbar.update(len(batch))
 
-        # Clear the batch.
-        batch = []
-        max_prompt_len = 0
-        max_output_len = 0
-    end = time.time()
+    # Warm up so that torch.compile and the CUDA graph capture are not
+    # included in the measured time. With the static cache, the input shape
+    # only depends on the padded prompt length, so warm up on one batch per
+    # padded prompt length. Otherwise, nothing is compiled and a single batch
+    # is enough.
+    # NOTE: With mode="reduce-overhead", a new graph is first run without a
+    # CUDA graph, which is only recorded on a later call. Thus, each warm-up
+    # batch is run twice with enough tokens to run the decoding step twice.
+    warmup_batches: Dict[int, List[str]] = {}
+    for batch, max_prompt_len, _ in batches:
+        warmup_batches.setdefault(max_prompt_len, batch)
+        if not use_static_cache:
+            break
+    for batch in warmup_batches.values():
+        input_ids, attention_mask = tokenize(batch)
+        input_ids = input_ids.cuda()
+        attention_mask = attention_mask.cuda()
+        for _ in range(2):
+            generate(input_ids, attention_mask, max_output_len=3)
+
+    pbar = tqdm(total=len(requests))
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    # Tokenize the next batch in a background thread while the GPU generates
+    # the current one.
+    decode_futures: List[Future] = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if batches:
+            future = executor.submit(tokenize, batches[0][0])
+        for i, (batch, _, max_output_len) in enumerate(batches):
+            input_ids, attention_mask = future.result()
+            input_ids = input_ids.cuda(non_blocking=True)
+            attention_mask = attention_mask.cuda(non_blocking=True)
+            if i + 1 < len(batches):
+                future = executor.submit(tokenize, batches[i + 1][0])
+
+            # Generate the sequences.
+            llm_outputs = generate(input_ids, attention_mask, max_output_len)
+            # Detokenize the outputs in the background thread so that it
+            # overlaps with the generation of the next batch. Skip the outputs
+            # of the prompts added to pad the batch.
+            llm_outputs = llm_outputs[:len(batch) * n]
+            decode_futures.append(
+                executor.submit(tokenizer.batch_decode, llm_outputs,
+                                skip_special_tokens=True))
+            pbar.update(len(batch))
+        # Wait for the detokenization to finish and surface its errors.
+        for decode_future in decode_futures:
+            decode_future.result()
+    torch.cuda.synchronize()
+    end = time.perf_counter()
     return end - start
 
 
 def main(args: argparse.Namespace):
     print(args)
-    random.seed(args.seed)
-
-    # Sample the requests.
-    tokenizer = get_tokenizer(args.model)
-    requests = sample_requests(args.dataset, args.num_prompts, tokenizer)
+    seed_everything(args.seed)
 
     if args.backend == "vllm":
-        elapsed_time = run_vllm(
-            requests, args.model, args.tensor_parallel_size, args.seed, args.n,
-            args.use_beam_search)
+        llm = LLM(
+            model=args.model,
+            tensor_parallel_size=args.tensor_parallel_size,
+            dtype=args.dtype,
+            seed=args.seed,
+            use_dummy_weights=True,
+            max_num_seqs=args.batch_size,
+            gpu_memory_utilization=args.gpu_memory_utilization,
+            max_num_batched_tokens=args.max_num_batched_tokens,
+        )
+        # Sample the requests with the tokenizer that vLLM has already loaded.
+        requests = sample_requests(args.num_prompts, llm.get_tokenizer())
+        elapsed_time = run_vllm(requests, llm, args.n, args.use_beam_search)
     elif args.backend == "hf":
         assert args.tensor_parallel_size == 1
+        # Sample the requests.
+        tokenizer = get_tokenizer(args.model)
+        # Pad on the left so that the generated tokens directly follow the
+        # prompts.
+        tokenizer.padding_side = "left"
+        requests = sample_requests(args.num_prompts, tokenizer)
         elapsed_time = run_hf(requests, args.model, tokenizer, args.n,
                               args.use_beam_search, args.hf_max_batch_size)
     else:
         raise ValueError(f"Unknown backend: {args.backend}")
     total_num_tokens = sum(
-        prompt_len + output_len
-        for _, prompt_len, output_len in requests
+        request.prompt_len + request.output_len
+        for request in requests
     )
     print(f"Throughput: {len(requests) / elapsed_time:.2f} requests/s, "
           f"{total_num_tokens / elapsed_time:.2f} tokens/s")
@@ -227,10 +337,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Benchmark the throughput.")
     parser.add_argument("--backend", type=str, choices=["vllm", "hf"],
                         default="vllm")
-    parser.add_argument("--dataset", type=str, required=True,
-                        help="Path to the dataset.")
     parser.add_argument("--model", type=str, default="facebook/opt-125m")
     parser.add_argument("--tensor-parallel-size", "-tp", type=int, default=1)
+    parser.add_argument("--dtype", type=str, default="auto",
+                        choices=["auto", "half", "bfloat16", "float"],
+                        help="Data type for the vLLM model weights, "
+                             "activations, and KV cache.")
     parser.add_argument("--n", type=int, default=1,
                         help="Number of generated sequences per prompt.")
     parser.add_argument("--use-beam-search", action="store_true")
@@ -240,16 +352,47 @@ if __name__ == "__main__":
     parser.add_argument("--hf-max-batch-size", type=int, default=None,
                         help="Maximum batch size for HF backend.")
     parser.add_argument("--batch-size", type=int, default=24)
+    parser.add_argument("--gpu-memory-utilization", type=float, default=0.95,
+                        help="Fraction of GPU memory to use for the vLLM "
+                             "model executor, including the KV cache.")
     parser.add_argument("--min-prompt-len", type=int, default=128)
     parser.add_argument("--max-prompt-len", type=int, default=256)
     parser.add_argument("--min-response-len", type=int, default=256)
     parser.add_argument("--max-response-len", type=int, default=512)
+    parser.add_argument("--max-num-batched-tokens", type=int, default=None,
+                        help="Maximum number of batched tokens per iteration "
+                             "for vLLM. Defaults to the batch size times the "
+                             "expected sequence length, with a 1.25x margin.")
     args = parser.parse_args()
     if args.backend == "vllm":
         if args.hf_max_batch_size is not None:
             raise ValueError("HF max batch size is only for HF backend.")
+        if args.max_num_batched_tokens is None:
+            # Size the budget for sequences of the expected length rather than
+            # the worst case where every sequence has the maximum length.
+            avg_prompt_len = (args.min_prompt_len + args.max_prompt_len) / 2
+            avg_response_len = (args.min_response_len +
+                                args.max_response_len) / 2
+            args.max_num_batched_tokens = max(
+                int(1.25 * args.batch_size *
+                    (avg_prompt_len + avg_response_len)),
+                args.max_prompt_len + 1)
+        if args.max_num_batched_tokens <= args.max_prompt_len:
+            raise ValueError("Max num batched tokens must be larger than the "
+                             "max prompt length.")
+        if args.gpu_memory_utilization > 0.95:
+            print("WARNING: GPU memory utilization above 0.95 leaves little "
+                  "headroom for memory that is not profiled by vLLM and may "
+                  "cause out-of-memory errors.")
     elif args.backend == "hf":
         if args.hf_max_batch_size is None:
             raise ValueError("HF max batch size is required for HF backend.")
+        if args.dtype != parser.get_default("dtype"):
+            raise ValueError("Data type is only for vLLM backend.")
+        if (args.gpu_memory_utilization !=
+                parser.get_default("gpu_memory_utilization")):
+            raise ValueError("GPU memory utilization is only for vLLM backend.")
+        if args.max_num_batched_tokens is not None:
+            raise ValueError("Max num batched tokens is only for vLLM backend.")
 
     main(args)
@@ -13,6 +13,8 @@ from vllm.sequence import (Sequence, SequenceData, SequenceGroup,
 logger = init_logger(__name__)
 
 _LOGGING_INTERVAL_SEC = 5
+# Log a warning once every this many preemptions.
+_PREEMPTION_WARNING_INTERVAL = 50
 
 
 class PreemptionMode(enum.Enum):
@@ -79,6 +81,7 @@ class Scheduler:
         self.last_logging_time: float = 0.0
         # List[timestamp, num_tokens]
         self.num_input_tokens: List[Tuple[float, int]] = []
+        self.num_cumulative_preemption: int = 0
 
     def add_seq_group(self, seq_group: SequenceGroup) -> None:
         # Add sequence groups to the waiting queue.
@@ -363,6 +366,15 @@ class Scheduler:
                 preemption_mode = PreemptionMode.RECOMPUTE
             else:
                 preemption_mode = PreemptionMode.SWAP
+        if self.num_cumulative_preemption % _PREEMPTION_WARNING_INTERVAL == 0:
+            logger.warning(
+                f"Sequence group {seq_group.request_id} is preempted by "
+                f"{preemption_mode.name} mode because there is not enough KV "
+                "cache space. Consider increasing gpu_memory_utilization or "
+                "decreasing max_num_seqs or max_num_batched_tokens. Total "
+                "number of preemptions: "
+                f"{self.num_cumulative_preemption + 1}")
+        self.num_cumulative_preemption += 1
         if preemption_mode == PreemptionMode.RECOMPUTE:
             self._preempt_by_recompute(seq_group)
         elif preemption_mode == PreemptionMode.SWAP:
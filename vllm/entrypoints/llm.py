@@ -63,7 +63,8 @@ class LLM:
     def generate(
         self,
         prompts: Optional[Union[str, List[str]]] = None,
-        sampling_params: Optional[SamplingParams] = None,
+        sampling_params: Optional[Union[SamplingParams,
+                                        List[SamplingParams]]] = None,
         prompt_token_ids: Optional[List[List[int]]] = None,
         use_tqdm: bool = True,
     ) -> List[RequestOutput]:
@@ -76,7 +77,8 @@ class LLM:
         Args:
             prompts: A list of prompts to generate completions for.
             sampling_params: The sampling parameters for text generation. If
-                None, we use the default sampling parameters.
+                None, we use the default sampling parameters. If a list, it
+                must have one `SamplingParams` per prompt.
             prompt_token_ids: A list of token IDs for the prompts. If None, we
                 use the tokenizer to convert the prompts to token IDs.
             use_tqdm: Whether to use tqdm to display the progress bar.
@@ -104,13 +106,21 @@ class LLM:
             num_requests = len(prompts)
         else:
             num_requests = len(prompt_token_ids)
+        if isinstance(sampling_params, list):
+            if len(sampling_params) != num_requests:
+                raise ValueError("The lengths of prompts and sampling_params "
+                                 "must be the same.")
         for i in range(num_requests):
             prompt = prompts[i] if prompts is not None else None
             if prompt_token_ids is None:
                 token_ids = None
             else:
                 token_ids = prompt_token_ids[i]
-            self._add_request(prompt, sampling_params, token_ids)
+            if isinstance(sampling_params, list):
+                params = sampling_params[i]
+            else:
+                params = sampling_params
+            self._add_request(prompt, params, token_ids)
         return self._run_engine(use_tqdm)
 
     def _add_request(